@@ -6,25 +6,61 @@ Collects Lethal Company mods from Thunderstore (thunderstore.io).
 
 import argparse
 import bs4
+import concurrent.futures
 import dataclasses
 import datetime
+import functools
+import io
+import json
 import logging
+import mmap
 import os
 import pathlib
 import re
 import requests
+import requests_cache
 import shutil
+import stat
 import sys
-import urllib.parse
+import threading
+import typing
+import urllib3
 import zipfile
 
 DOMAIN = "thunderstore.io"
 DOMAIN_SCHEMA = f"https://{DOMAIN}"
+DOMAIN_PREFIXES = (f"https://{DOMAIN}/", f"http://{DOMAIN}/")
+
+# Only the tags holding mod data are parsed from mod pages.
+PAGE_STRAINER = bs4.SoupStrainer(["h1", "table", "h5"])
 
 LV1_FOLDER_NAME = "BepInEx"
 LVL1_FOLDER = pathlib.Path(LV1_FOLDER_NAME)
 LVL2_FOLDER_NAMES = ["cache", "config", "core", "patchers", "plugins"]
 LVL2_FOLDERS = [pathlib.Path(p) for p in LVL2_FOLDER_NAMES]
+LVL1_FOLDER_NAME_LOWER = LV1_FOLDER_NAME.lower()
+LVL2_FOLDER_NAMES_LOWER = frozenset(f.lower() for f in LVL2_FOLDER_NAMES)
+
+URL_PATTERN = re.compile(rb"<([^>]+)>")
+
+# Replacements ZipFile.extract makes in member names on Windows.
+WINDOWS_ILLEGAL_CHARS = str.maketrans(':<>|"?*', "_" * 7)
+
+SKIPPED_FILES = ["icon.png", "manifest.json", "README.md", "CHANGELOG.md"]
+
+LISTING_WORKERS = 16
+DOWNLOAD_WORKERS = 8
+EXTRACT_WORKERS = 8
+
+COPY_BUFFER_SIZE = 1 << 16
+MAX_IN_MEMORY_SIZE = 100 * 1024 * 1024
+
+# Response headers saved with archives, and the request headers they become.
+VALIDATOR_HEADERS = {"ETag": "If-None-Match", "Last-Modified": "If-Modified-Since"}
+
+# Shared session, created on first use by get_session.
+SESSION = None
+SESSION_LOCK = threading.Lock()
 
 
 @dataclasses.dataclass
@@ -67,6 +103,12 @@ def __main():
         const=pathlib.Path(f"LC_modlist_{time_stamp}.txt"),
         help="Export formatted mod list from acquired data",
     )
+    parser.add_argument(
+        "-m",
+        "--in-memory",
+        action="store_true",
+        help="Extract archives from memory instead of saving them (except large ones)",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -89,7 +131,7 @@ def __main():
 
     # Check if all URLs are from the correct domain.
     for url in urls:
-        if urllib.parse.urlparse(url).netloc != DOMAIN:
+        if not url.startswith(DOMAIN_PREFIXES):
             exit_failure(f"URL not from {DOMAIN}: {url}")
 
     # Collect mod data.
@@ -108,22 +150,98 @@ def __main():
             f"version {mod.version}, <{mod.url}>)"
         )
 
-    # Download all mods.
-    all_mods = original_mods[::]
-    all_mods.extend(dependencies)
-
-    mod_paths = []
-    for mod in all_mods:
-        mod_path = download_mod_from_listing(mod)
-        mod_paths.append(mod_path)
-
     # Create base file tree.
     base_path = pathlib.Path(f"LC_modpack_{time_stamp}")
     create_modpack_tree(base_path)
 
-    # Extract mods (dependencies first).
-    for mod_path in reversed(mod_paths):
-        extract_mod(base_path, mod_path)
+    # Download all mods, extracting each one as soon as it arrives.
+    all_mods = original_mods[::]
+    all_mods.extend(dependencies)
+
+    download_and_extract_mods(base_path, all_mods, args.in_memory)
+
+
+def download_and_extract_mods(
+    base_path: pathlib.Path, mods: [ModListing], in_memory: bool
+):
+    """Downloads mods and extracts each one into the base tree once it arrives.
+
+    When archives share a file, the earlier mod keeps it: listed mods in file
+    order, then dependencies, then BepInEx, so any mod can override its files.
+    """
+    download = functools.partial(download_mod_from_listing, in_memory=in_memory)
+
+    # The same mod can be reached through different URLs, download it only once.
+    unique_mods = {}
+    for mod in mods:
+        unique_mods.setdefault(mod.full_id(), mod)
+    mods = list(unique_mods.values())
+
+    # Rank of the archive that first wrote each file, and of the file's owner.
+    written = {}
+    owners = {}
+    # Archives kept for a later rewrite, the rest are released once extracted.
+    archives = {}
+
+    # zlib releases the GIL while decompressing, so threads extract in parallel.
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=EXTRACT_WORKERS
+    ) as extractor:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=DOWNLOAD_WORKERS
+        ) as downloader:
+            download_futures = {
+                downloader.submit(download, mod): i for i, mod in enumerate(mods)
+            }
+
+            extract_futures = []
+            for future in concurrent.futures.as_completed(download_futures):
+                mod_path = future.result()
+                rank = download_futures.pop(future)
+                if is_bepinex_archive(mod_path):
+                    rank += len(mods)
+
+                # Files already written by another archive are left for later,
+                # so no two workers ever write the same file.
+                members = []
+                for name, dest in get_mod_members(base_path, mod_path):
+                    # Folders are shared, files belong to a single archive.
+                    if is_folder_member(name):
+                        members.append((name, dest))
+                        continue
+
+                    key = os.path.normcase(dest)
+                    if key not in written:
+                        members.append((name, dest))
+                        written.setdefault(key, rank)
+                    if key not in owners or rank < owners[key][0]:
+                        owners[key] = (rank, name, dest)
+
+                pending = {r for key, (r, _, _) in owners.items() if written[key] != r}
+                archives = {r: archives[r] for r in archives if r in pending}
+                if rank in pending:
+                    archives[rank] = mod_path
+
+                extract_futures.append(
+                    extractor.submit(extract_members, mod_path, members)
+                )
+
+        for future in extract_futures:
+            future.result()
+
+        # Files first written by an archive that does not own them are written
+        # again from their owner.
+        rewrites = {}
+        for key, (rank, name, dest) in owners.items():
+            if written[key] != rank:
+                rewrites.setdefault(rank, (archives[rank], []))[1].append((name, dest))
+
+        rewrite_futures = [
+            extractor.submit(extract_members, mod_path, members)
+            for mod_path, members in rewrites.values()
+        ]
+        for future in rewrite_futures:
+            future.result()
 
 
 def create_modpack_tree(base_path: pathlib.Path):
@@ -139,54 +257,119 @@ def create_modpack_tree(base_path: pathlib.Path):
         os.mkdir(base_path / LVL1_FOLDER / lvl2_folder)
 
 
-def extract_mod(base_path: pathlib.Path, mod_path: pathlib.Path):
-    """Tries extracting the mod to the correct place in the base tree."""
-    logging.info(f"Verifying: {mod_path}")
-    file = zipfile.ZipFile(mod_path)
-    contents = [
-        c
-        for c in file.namelist()
-        if c not in ["icon.png", "manifest.json", "README.md", "CHANGELOG.md"]
-    ]
-    paths = [pathlib.Path(c) for c in contents]
-
-    # Determines where to extract files.
-    is_bepinex = False
-    if any(path.parts[0] == "BepInExPack" for path in paths):
+def is_bepinex_archive(mod_path: typing.Union[pathlib.Path, io.BytesIO]) -> bool:
+    """Checks if the mod archive is the BepInEx pack."""
+    with zipfile.ZipFile(mod_path) as file:
+        return any(pathlib.Path(c).parts[0] == "BepInExPack" for c in file.namelist())
+
+
+def get_mod_members(
+    base_path: pathlib.Path, mod_path: typing.Union[pathlib.Path, io.BytesIO]
+) -> [(str, pathlib.Path)]:
+    """Returns the mod's archive members and where in the base tree they go."""
+    with zipfile.ZipFile(mod_path) as file:
+        archive_name = file.filename
+        logging.info(f"Verifying: {archive_name}")
+        names = [n for n in file.namelist() if n not in SKIPPED_FILES]
+        paths = [get_member_path(n) for n in names]
+
+    # Members whose whole name was sanitized away are skipped.
+    names = [n for n, p in zip(names, paths) if p.parts]
+    paths = [p for p in paths if p.parts]
+
+    # Determines where to extract files, in a single pass over the paths.
+    is_bepinex = has_lvl1 = has_lvl2 = False
+    for path in paths:
+        top = path.parts[0]
+        if top == "BepInExPack":
+            # BepInEx takes precedence over everything else.
+            is_bepinex = True
+            break
+        top = top.lower()
+        has_lvl1 = has_lvl1 or top == LVL1_FOLDER_NAME_LOWER
+        has_lvl2 = has_lvl2 or top in LVL2_FOLDER_NAMES_LOWER
+
+    if is_bepinex:
         # Mod is BepInEx.
-        is_bepinex = True
+        logging.info(f"BepInEx detected: {archive_name}")
         extract_path = base_path
-    elif any(path.parts[0].lower() == LV1_FOLDER_NAME.lower() for path in paths):
+    elif has_lvl1:
         # Mod should be placed in root.
         extract_path = base_path
-    elif any(
-        path.parts[0].lower() in [f.lower() for f in LVL2_FOLDER_NAMES]
-        for path in paths
-    ):
+    elif has_lvl2:
         # Mod should be placed in BepInEx folder.
         extract_path = base_path / pathlib.Path("BepInEx")
     else:
         # Mod should be placed in BepInEx/plugins
         extract_path = base_path / pathlib.Path("BepInEx/plugins")
 
-    logging.info(f"Unpacking: {mod_path}")
-    for content in contents:
-        file.extract(content, extract_path)
-    if is_bepinex:
-        logging.info(f"BepInEx detected: {mod_path}")
-        pack_path = extract_path / pathlib.Path("BepInExPack")
-        shutil.copytree(pack_path, extract_path, dirs_exist_ok=True)
-        shutil.rmtree(pack_path)
+    members = []
+    for name, path in zip(names, paths):
+        if is_bepinex and path.parts[0] == "BepInExPack":
+            # Pack contents go straight to the root of the tree.
+            path = pathlib.Path(*path.parts[1:])
+        members.append((name, extract_path / path))
+
+    return members
+
+
+def is_folder_member(name: str) -> bool:
+    """Checks if the archive member name is a folder entry."""
+    return name.endswith("/")
+
+
+def extract_members(
+    mod_path: typing.Union[pathlib.Path, io.BytesIO], members: [(str, pathlib.Path)]
+):
+    """Extracts the given archive members to their destinations."""
+    with zipfile.ZipFile(mod_path) as file:
+        # Creates every destination folder once, parents first.
+        dirs = {d if is_folder_member(n) else d.parent for n, d in members}
+        for d in sorted(dirs, key=lambda p: len(p.parts)):
+            d.mkdir(parents=True, exist_ok=True)
+
+        logging.info(f"Unpacking: {file.filename}")
+        for name, dest in members:
+            if not is_folder_member(name):
+                extract_member(file, name, dest)
 
-    file.close()
+
+def get_member_path(name: str) -> pathlib.Path:
+    """Returns the relative path of an archive member, as ZipFile.extract does."""
+    name = name.replace("/", os.sep)
+    if os.altsep:
+        name = name.replace(os.altsep, os.sep)
+
+    # Drops drives, root and empty, "." and ".." components.
+    name = os.path.splitdrive(name)[1]
+    parts = [p for p in name.split(os.sep) if p not in ["", os.curdir, os.pardir]]
+
+    if os.sep == "\\":
+        # Replaces characters Windows forbids and strips trailing dots.
+        parts = [p.translate(WINDOWS_ILLEGAL_CHARS).rstrip(".") for p in parts]
+        parts = [p for p in parts if p]
+
+    return pathlib.Path(*parts)
+
+
+def extract_member(file: zipfile.ZipFile, name: str, dest: pathlib.Path):
+    """Streams a single archive file to the destination path."""
+    with file.open(name) as src, open(dest, mode="wb") as dst:
+        shutil.copyfileobj(src, dst, length=COPY_BUFFER_SIZE)
 
 
 def get_urls_from_file(file: pathlib.Path) -> [str]:
     """Returns URLs between brackets (e.g. <example.com>) from file."""
     logging.info(f"Reading: {file}")
 
-    with open(file, encoding="utf-8") as f:
-        urls = re.findall("<([^>]+)>", f.read())
+    with open(file, mode="rb") as f:
+        # Only non-empty regular files can be memory-mapped, pipes are read.
+        info = os.fstat(f.fileno())
+        if stat.S_ISREG(info.st_mode) and info.st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                urls = [m.group(1).decode("utf-8") for m in URL_PATTERN.finditer(mm)]
+        else:
+            urls = [m.group(1).decode("utf-8") for m in URL_PATTERN.finditer(f.read())]
 
     logging.info(f"Found {len(urls)} URLs")
 
@@ -205,75 +388,154 @@ def export_mod_list(file: pathlib.Path, listings: [ModListing]):
             f.write(line)
 
 
-def download_mod_from_listing(mod: ModListing) -> pathlib.Path:
-    """Download mod from ModListing using given URL and data, return path."""
+def download_mod_from_listing(
+    mod: ModListing, in_memory: bool = False
+) -> typing.Union[pathlib.Path, io.BytesIO]:
+    """Download mod from ModListing, return its path or in-memory archive."""
     path = pathlib.Path(f"{mod.full_id()}.zip")
+    validators_path = path.with_name(f"{path.name}.json")
+
+    # Archives with saved validators are only downloaded again if changed.
+    headers = {}
     if path.is_file():
-        logging.info(f"Skipping download, archive found at: {path}")
-        return path
+        if not validators_path.is_file():
+            logging.info(f"Skipping download, archive found at: {path}")
+            return path
+        headers = load_conditional_headers(validators_path)
 
     logging.info(f"Downloading mod: {mod.name}")
-    file = get_data_from_url(mod.download)
-
-    logging.info(f"Saving mod {mod.name} as {path}")
-    with open(path, mode="wb") as f:
-        for chunk in file.iter_content(chunk_size=1024):
-            f.write(chunk)
+    with get_data_from_url(mod.download, timeout=30, stream=True, headers=headers) as r:
+        if r.status_code == 304:
+            logging.info(f"Skipping download, archive up to date at: {path}")
+            return path
+
+        size = r.headers.get("Content-Length")
+        if in_memory and size is not None and int(size) <= MAX_IN_MEMORY_SIZE:
+            logging.info(f"Keeping mod {mod.name} in memory")
+            archive = io.BytesIO(r.content)
+            # Lets ZipFile report the archive by name.
+            archive.name = path.name
+            return archive
+
+        logging.info(f"Saving mod {mod.name} as {path}")
+        r.raw.decode_content = True
+        # Only complete downloads take the archive's name.
+        partial_path = path.with_name(f"{path.name}.part")
+        with open(partial_path, mode="wb") as f:
+            shutil.copyfileobj(r.raw, f, length=COPY_BUFFER_SIZE)
+        os.replace(partial_path, path)
+        save_validators(validators_path, r)
 
     return path
 
 
+def save_validators(file: pathlib.Path, response: requests.models.Response):
+    """Saves the response's cache validators (ETag, Last-Modified), if any."""
+    validators = {
+        h: response.headers[h] for h in VALIDATOR_HEADERS if h in response.headers
+    }
+    if not validators:
+        file.unlink(missing_ok=True)
+        return
+
+    with open(file, encoding="utf-8", mode="w") as f:
+        json.dump(validators, f)
+
+
+def load_conditional_headers(file: pathlib.Path) -> dict:
+    """Returns conditional request headers from saved cache validators."""
+    with open(file, encoding="utf-8") as f:
+        validators = json.load(f)
+
+    return {VALIDATOR_HEADERS[h]: v for h, v in validators.items()}
+
+
 def collect_mod_data(urls: [str]) -> ([ModListing], [ModListing]):
     """Gets data for all mods pointed by the URL list and their dependencies."""
     logging.info(f"Collecting mod data from {len(urls)} URL(s)")
 
-    n_mods = len(urls)
     listings = []
 
+    # Listed mods keep the order of the file.
+    url_order = {url: i for i, url in enumerate(dict.fromkeys(urls))}
+
     urls = set(urls)
+    original_urls = set(urls)
     new_urls = urls
 
-    while True:
-        new_listings = [get_mod_listing(url) for url in new_urls]
-        listings.extend(new_listings)
-
-        new_urls = set(dep for listing in new_listings for dep in listing.dependencies)
-        new_urls.difference_update(urls)
-
-        # All dependencies have been gotten.
-        if len(new_urls) == 0:
-            logging.info("No more dependencies found")
-            break
+    # Listings are independent, so each wave of URLs is fetched concurrently.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=LISTING_WORKERS) as ex:
+        while True:
+            new_listings = [
+                listing
+                for listing in ex.map(try_get_mod_listing, sorted(new_urls))
+                if listing is not None
+            ]
+            listings.extend(new_listings)
+
+            new_urls = set(
+                dep for listing in new_listings for dep in listing.dependencies
+            )
+            new_urls.difference_update(urls)
+
+            # All dependencies have been gotten.
+            if len(new_urls) == 0:
+                logging.info("No more dependencies found")
+                break
+
+            logging.info(f"New dependencies found: <{'>, <'.join(new_urls)}>")
+
+            urls.update(new_urls)
+
+    # Mods from the list cannot be left out, but dependencies only warn.
+    read_urls = set(listing.url for listing in listings)
+    missing_mods = original_urls - read_urls
+    if missing_mods:
+        exit_failure(f"Could not read mod listing(s): <{'>, <'.join(missing_mods)}>")
+    missing_deps = urls - read_urls
+    if missing_deps:
+        logging.warning(
+            f"Leaving out unreadable dependencies: <{'>, <'.join(missing_deps)}>"
+        )
 
-        logging.info(f"New dependencies found: <{'>, <'.join(new_urls)}>")
+    original_mods = [listing for listing in listings if listing.url in original_urls]
+    original_mods.sort(key=lambda m: url_order[m.url])
+    dependencies = [listing for listing in listings if listing.url not in original_urls]
 
-        urls.update(new_urls)
+    return original_mods, dependencies
 
-    original_mods = listings[:n_mods]
-    dependencies = listings[n_mods:]
 
-    return original_mods, dependencies
+def try_get_mod_listing(url: str) -> typing.Optional[ModListing]:
+    """Creates a ModListing object from mod url or returns None if it fails."""
+    try:
+        return get_mod_listing(url)
+    # pylint: disable=broad-exception-caught
+    except Exception as e:
+        logging.error(f"Error reading mod listing <{url}>: {e}")
+        return None
 
 
 def get_mod_listing(url: str) -> ModListing:
     """Creates a ModListing object from mod url."""
     logging.info(f"Getting info from: <{url}>")
 
-    html = bs4.BeautifulSoup(get_data_from_url(url).text, features="html.parser")
+    html = bs4.BeautifulSoup(
+        get_data_from_url(url).text, features="lxml", parse_only=PAGE_STRAINER
+    )
 
     # Name.
-    name = html.find("h1", class_="mt-0").text
+    name = html.select_one("h1.mt-0").text
 
     # Data from latest version.
-    latest = html.find_all("table", class_="table mb-0")[1].find_all("tr")[1]
-    date, version, _, download, *_ = latest.find_all("td")
+    latest = html.select('table[class="table mb-0"]')[1].select("tr")[1]
+    date, version, _, download, *_ = latest.select("td")
 
     date = datetime.datetime.strptime(date.text, "%Y-%m-%d").date()
     version = version.text
     download = download.a["href"]
 
     # Dependency URLs.
-    deps = [f.a["href"] for f in html.find_all("h5", class_="mt-0")]
+    deps = [h5.a["href"] for h5 in html.select("h5.mt-0")]
     deps = [DOMAIN_SCHEMA + dep for dep in deps]
 
     logging.info(
@@ -290,15 +552,51 @@ def get_mod_listing(url: str) -> ModListing:
     )
 
 
-def get_data_from_url(url: str) -> requests.models.Response:
+def get_session() -> requests.Session:
+    """Returns the session shared by all requests, creating it on first use.
+
+    Connections to Thunderstore are kept alive and reused. Mod pages are cached
+    between runs; archives are already kept on disk.
+    """
+    global SESSION  # pylint: disable=global-statement
+    with SESSION_LOCK:
+        if SESSION is None:
+            SESSION = requests_cache.CachedSession(
+                "lc_mod_updater",
+                backend="sqlite",
+                use_cache_dir=True,
+                expire_after=3600,
+                filter_fn=is_page_response,
+            )
+            SESSION.mount(
+                "https://",
+                requests.adapters.HTTPAdapter(
+                    pool_connections=16,
+                    pool_maxsize=32,
+                    max_retries=urllib3.util.Retry(total=3, backoff_factor=0.3),
+                ),
+            )
+
+        return SESSION
+
+
+def is_page_response(response: requests.models.Response) -> bool:
+    """Checks if the response is an HTML page, which is worth caching."""
+    return response.headers.get("Content-Type", "").startswith("text/html")
+
+
+def get_data_from_url(
+    url: str, timeout: float = 5, stream: bool = False, headers: dict = None
+) -> requests.models.Response:
     """Return data from a URL or None if it fails."""
     try:
-        r = requests.get(url, timeout=5)
+        r = get_session().get(url, timeout=timeout, stream=stream, headers=headers)
     # pylint: disable=broad-exception-caught]
     except Exception as e:
         exit_failure(f"Error obtaining URL <{url}>: {e}")
 
-    if r.status_code != 200:
+    # 304 only answers conditional requests, which handle it themselves.
+    if r.status_code not in [200, 304]:
         exit_failure(f"URL <{url}> returned code {r.status_code}")
 
     return r